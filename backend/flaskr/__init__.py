@@ -1,55 +1,187 @@
 import os
-from flask import Flask, request, abort, jsonify
+from flask import Flask, request, abort, current_app, stream_with_context
 from flask_sqlalchemy import SQLAlchemy
 from flask_cors import CORS
-import random
-from math import ceil
-
-from models import setup_db, Question, Category
+from sqlalchemy import Integer, all_, func, literal
+from sqlalchemy.dialects.postgresql import ARRAY
+from sqlalchemy.orm import raiseload
+from sqlalchemy.exc import SQLAlchemyError
+import time
+import io
+import gzip
+import base64
+import hashlib
+import orjson
+
+from models import (setup_db, db, pool_size, max_overflow, format_question,
+                    Question, Category)
 
 QUESTIONS_PER_PAGE = 10
 
+# In process cache of the categories, the entry holds the time it was built,
+# the categories dict, the encoded /categories response body, its gzip and
+# its etag, it is replaced as a whole so readers never see a partial entry
+_CAT_CACHE = {'entry': None}
+_CAT_TTL = 300
+
+# Error responses bodies encoded once as they never change
+_ERR = {
+    code: orjson.dumps({'success': False, 'error': code, 'message': msg})
+    for code, msg in [(400, 'bad request'),
+                      (404, 'resource not found'),
+                      (405, 'method not allowed'),
+                      (422, 'unprocessable')]
+}
+
+
+# Helper function to get the categories cache entry
+# or build it from the database if the cache is empty or expired
+def _get_categories_entry():
+    now = time.monotonic()
+    entry = _CAT_CACHE['entry']
+    if entry is None or now - entry[0] > _CAT_TTL:
+        categories = Category.query.order_by(Category.id).all()
+        data = {cat.id: cat.type for cat in categories}
+        body = orjson.dumps({
+            'success': True,
+            'categories': data,
+        }, option=orjson.OPT_NON_STR_KEYS)
+        # Compress with a fixed mtime so the gzip bytes are the same
+        # for every refresh and worker, as the etag is a strong one
+        buffer = io.BytesIO()
+        with gzip.GzipFile(fileobj=buffer, mode='wb', mtime=0) as gz_file:
+            gz_file.write(body)
+        gz = buffer.getvalue()
+        etag = hashlib.md5(body).hexdigest()
+        entry = (now, data, body, gz, etag)
+        _CAT_CACHE['entry'] = entry
+    return entry
+
+
+# Helper function to get the categories dict from the cache
+def _get_categories():
+    return _get_categories_entry()[1]
+
+
+# Helper function to query the questions, any lazy load will raise an error
+# instead of silently issuing one more query per question
+def query_questions():
+    return Question.query.options(raiseload('*'))
+
+
+# Helper function to query only the questions columns for the read endpoints,
+# it returns light rows instead of the ORM objects with their instrumentation
+def query_question_rows():
+    return db.session.query(Question.id, Question.question, Question.answer,
+                            Question.category, Question.difficulty)
+
+
+# Helper function to format the questions rows (or objects) as dicts
+def _rows_to_dicts(rows):
+    return [format_question(row) for row in rows]
+
+
+# Helper function to count the questions of a query with a single SELECT COUNT
+def count_questions(query):
+    return query.order_by(None).with_entities(
+        func.count(Question.id)).scalar()
+
 
 # Helper function tp paginate the questions
-def paginate_questions(request, selection, page_num=1):
+def paginate_questions(request, query):
     # Get the page number or use the default (first page)
-    page = request.args.get('page', page_num, type=int)
+    page = request.args.get('page', 1, type=int)
     # Start question number
     start = (page - 1) * QUESTIONS_PER_PAGE
-    # End question number
-    end = start + QUESTIONS_PER_PAGE
 
-    # Geting all questions from the database
-    questions = [question.format() for question in selection]
-    # Select only 10 questions to view per page
-    current_questions = questions[start:end]
+    # There are no questions before the first page
+    if page < 1:
+        return []
+
+    # Select only 10 questions to view per page from the database
+    questions = query.limit(QUESTIONS_PER_PAGE).offset(start).all()
 
     # Return the current questions
-    return current_questions
+    return _rows_to_dicts(questions)
+
+
+# Helper function to parse the request body using orjson
+def _json_body():
+    # Read the raw body without caching it a second time in the request
+    data = request.get_data(cache=False)
+    if not data:
+        return {}
+    try:
+        body = orjson.loads(data)
+    except orjson.JSONDecodeError:
+        # Abort with status code 400 bad request for invalid json
+        abort(400)
+
+    # Abort with status code 400 bad request if the body isn't an object
+    if not isinstance(body, dict):
+        abort(400)
+    return body
+
+
+# Helper function to build an opaque cursor from the last question id
+def encode_cursor(question_id):
+    return base64.urlsafe_b64encode(
+        str(question_id).encode()).decode().rstrip('=')
+
+
+# Helper function to get the question id back from a cursor
+def decode_cursor(cursor):
+    try:
+        padding = '=' * (-len(cursor) % 4)
+        return int(base64.urlsafe_b64decode(cursor + padding))
+    except ValueError:
+        # Abort with status code 400 bad request for invalid cursors
+        abort(400)
+
+
+# Helper function to get the cursor of the next page if there is one
+def next_cursor(questions):
+    if len(questions) < QUESTIONS_PER_PAGE:
+        return None
+    return encode_cursor(questions[-1]['id'])
+
+
+# Helper function to build a json response using orjson
+def ojson(payload, status=200):
+    # orjson returns bytes so they are passed to the response as is,
+    # non str keys (like the categories ids) are serialized as strings
+    return current_app.response_class(
+        orjson.dumps(payload, option=orjson.OPT_NON_STR_KEYS),
+        status=status, mimetype='application/json')
 
 
 def create_app(test_config=None):
     # create and configure the app
     app = Flask(__name__)
+    # Size the connection pool for concurrent requests and check the
+    # connections before using them instead of failing on dropped ones,
+    # every gunicorn worker has its own pool (see gunicorn.conf.py)
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+        'pool_size': pool_size,
+        'max_overflow': max_overflow,
+        'pool_pre_ping': True,
+        'pool_recycle': 1800,
+        'pool_timeout': 5,
+    }
     setup_db(app)
 
     '''
     @Done: Set up CORS. Allow '*' for origins. Delete the sample route after completing the TODOs
     '''
-    CORS(app)
+    CORS(app, resources={r"/*": {"origins": "*"}},
+         allow_headers=['Content-Type', 'Authorization', 'true'],
+         methods=['GET', 'PUT', 'POST', 'DELETE', 'OPTIONS'])
 
     '''
     @Done: Use the after_request decorator to set Access-Control-Allow
     '''
-    # Using after request to allow for access control headers and methods
-    @app.after_request
-    def after_request(response):
-        response.headers.add('Access-Control-Allow-Headers',
-                             'Content-Type, Authorization, true')
-        response.headers.add('Access-Control-Allow-Methods',
-                             'GET, PUT, POST, DELETE, OPTIONS')
-        # Return the response object after adding the access control
-        return response
+    # Access control headers and methods are set by the CORS config above
+    # instead of adding them to every response in an after_request handler
 
     '''
     @Done:
@@ -63,19 +195,33 @@ def create_app(test_config=None):
         as a response for get request using /categories URL
         '''
 
-        # Getting all categories from the database and format it
-        categories = Category.query.order_by(Category.id).all()
-        cat_dict = {cat.id: cat.type for cat in categories}
+        # Getting all categories and their encoded bodies from the cache
+        _, cat_dict, body, gz, cat_etag = _get_categories_entry()
 
         # Check if no categories were found abort with status 404 not found
         if (len(cat_dict) == 0):
             abort(404)
 
+        # Use the gzip body if the client accepts it, each body has its own etag
+        use_gzip = request.accept_encodings['gzip'] > 0
+        etag = cat_etag + ('-gzip' if use_gzip else '')
+
+        # Return 304 not modified if the client already has the categories
+        if request.if_none_match.contains(etag):
+            response = app.response_class(status=304)
+        else:
+            response = app.response_class(
+                gz if use_gzip else body,
+                mimetype='application/json')
+            if use_gzip:
+                response.headers['Content-Encoding'] = 'gzip'
+
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = 'public, max-age={}'.format(_CAT_TTL)
+        response.vary.add('Accept-Encoding')
+
         # return data to view
-        return jsonify({
-            'success': True,
-            'categories': cat_dict,
-        })
+        return response
 
     '''
     @Done:
@@ -95,28 +241,60 @@ def create_app(test_config=None):
         Getting all questions from the database
         as a response for get request using /questions URL
         including pagination every 10 questions
+        using either ?page=<page_num> or ?after=<next_cursor>
         '''
 
-        # Get all questions and paginate them 10 questions per page
-        selection = Question.query.order_by(Question.id).all()
-        current_questions = paginate_questions(request, selection)
+        selection = query_question_rows().order_by(Question.id)
+        # Get the cursor of the previous page if any
+        after = request.args.get('after', None)
 
-        # Getting all categories from the database and format it
-        categories = Category.query.order_by(Category.id).all()
-        cat_dict = {cat.id: cat.type for cat in categories}
+        if after is not None:
+            # Get the 10 questions after the cursor using the id index
+            questions = selection.filter(
+                Question.id > decode_cursor(after)).limit(QUESTIONS_PER_PAGE)
+            current_questions = _rows_to_dicts(questions)
+        else:
+            # Get all questions and paginate them 10 questions per page
+            current_questions = paginate_questions(request, selection)
+
+        # Getting all categories from the cache
+        cat_dict = _get_categories()
 
         # abort 404 if no questions
         if (len(current_questions) == 0):
             abort(404)
 
         # return data to view
-        return jsonify({
+        return ojson({
             'success': True,
             'questions': current_questions,
-            'total_questions': len(selection),
+            'total_questions': count_questions(selection),
             'categories': cat_dict,
+            'next_cursor': next_cursor(current_questions),
         })
 
+    @app.route('/questions/stream')
+    def stream_questions():
+        '''
+        Streaming all questions from the database as a json list
+        using a server side cursor fetching 500 questions at a time
+        '''
+
+        def generate():
+            # Get all questions in batches instead of loading them at once
+            rows = query_question_rows().order_by(Question.id).yield_per(500)
+
+            # Encode each question on its own and stream it to the client
+            yield b'['
+            for index, row in enumerate(rows):
+                chunk = orjson.dumps(format_question(row))
+                yield b',' + chunk if index else chunk
+            yield b']'
+
+        # return the streamed data to view
+        return app.response_class(stream_with_context(generate()),
+                                  mimetype='application/json')
+
     '''
     @Done: 
     Create an endpoint to DELETE question using a question ID. 
@@ -129,33 +307,37 @@ def create_app(test_config=None):
         '''
         Delete a question from the database by question_id
         '''
+        start = time.monotonic()
         try:
-            # Get the question from the database by question_id
-            question = Question.query.filter(
-                Question.id == question_id).one_or_none()
-
-            # Abort if no question retrieved from the database with error status code 404 not found
-            if question is None:
-                abort(404)
+            # Delete the question from the data base with a single DELETE
+            deleted = Question.query.filter(
+                Question.id == question_id).delete(synchronize_session=False)
+            db.session.commit()
+
+        except SQLAlchemyError:
+            db.session.rollback()
+            app.logger.error('Deleting question %s failed after %.3fs',
+                             question_id, time.monotonic() - start,
+                             exc_info=True)
+            # Abort with status code 422 unprocessable
+            abort(422)
 
-            # Delete the question from the data base
-            question.delete()
-            # Get all questions from the data base
-            selection = Question.query.order_by(Question.id).all()
-            # Paginate the current questions to view
-            current_questions = paginate_questions(request, selection)
+        # Abort if no question was deleted from the database with error status code 404 not found
+        if deleted == 0:
+            abort(404)
 
-            # Return data to view
-            return jsonify({
-                'success': True,
-                'deleted': question_id,
-                'questions': current_questions,
-                'total_questions': len(selection)
-            })
+        # Get all questions from the data base
+        selection = query_questions().order_by(Question.id)
+        # Paginate the current questions to view
+        current_questions = paginate_questions(request, selection)
 
-        except:
-            # Abort with status code 422 unprocessable
-            abort(422)
+        # Return data to view
+        return ojson({
+            'success': True,
+            'deleted': question_id,
+            'questions': current_questions,
+            'total_questions': count_questions(selection)
+        })
 
     '''
     @Done: 
@@ -173,67 +355,89 @@ def create_app(test_config=None):
         Create a new question or search for questions in the database
         '''
         # Get the body from the request object
-        body = request.get_json()
+        body = _json_body()
 
         # Get the searchTerm
         search = body.get('searchTerm', None)
 
         # If there is a search term in the body return the questions with matched search term
         if search:
-            # Get questions with matched search term
-            selection = Question.query.order_by(Question.id).filter(
-                Question.question.ilike('%{}%'.format(search)))
+            # Get questions with matched search term, the pattern is sent
+            # as a bound parameter so the statement is the same for every search
+            pattern = f'%{search}%'
+            selection = query_question_rows().order_by(Question.id).filter(
+                Question.question.ilike(pattern))
+
+            # Count the matched questions once for the emptiness check and the total
+            total_questions = count_questions(selection)
 
-            if len(selection.all()) == 0:
+            if total_questions == 0:
                 abort(404)
 
             # Paginate the questions
             current_questions = paginate_questions(request, selection)
 
             # Return Data to view
-            return jsonify({
+            return ojson({
                 'success': True,
                 'questions': current_questions,
-                'total_questions': len(selection.all())
+                'total_questions': total_questions
             })
 
         else:
-            try:
-                # Get the data from the body
-                new_question = body.get('question', None)
-                new_answer = body.get('answer', None)
-                new_category = body.get('category', None)
-                new_difficulty = body.get('difficulty', None)
-
-                # Abort if any of the required data for new question is None with status code 422
-                if any(item is None for item in [new_question, new_answer, new_category, new_difficulty]):
-                    abort(422)
+            # Get the data from the body
+            new_question = body.get('question', None)
+            new_answer = body.get('answer', None)
+            new_category = body.get('category', None)
+            new_difficulty = body.get('difficulty', None)
+
+            # Abort if any of the required data for new question is None with status code 422
+            if any(item is None for item in [new_question, new_answer, new_category, new_difficulty]):
+                abort(422)
 
+            start = time.monotonic()
+            try:
                 # Create a new question object and add it to the data base
                 question = Question(question=new_question, answer=new_answer,
                                     category=new_category, difficulty=new_difficulty)
                 question.insert()
+                question_id = question.id
 
-                # Get the questions from the data base
-                selection = Question.query.order_by(Question.id).all()
-                # Get the last page number to show the created quistion
-                page_num = ceil(len(selection) / 10)
-                # Paginate the questions and view the last page
-                current_questions = paginate_questions(
-                    request, selection, page_num=page_num)
-
-                # Return data to view
-                return jsonify({
-                    'success': True,
-                    'created': question.id,
-                    'questions': current_questions,
-                    'total_questions': len(selection)
-                })
-
-            except:
+            except SQLAlchemyError:
+                db.session.rollback()
+                app.logger.error('Creating a question failed after %.3fs',
+                                 time.monotonic() - start, exc_info=True)
                 # Abort with status code 422 unprocessable
                 abort(422)
 
+            # The question is stored at this point, if getting the questions
+            # to view fails return the created question id without them
+            # instead of an error so the client doesn't submit it again
+            current_questions = []
+            total_questions = None
+            start = time.monotonic()
+            try:
+                # Get the last 10 questions to show the created quistion
+                selection = query_question_rows().order_by(
+                    Question.id.desc()).limit(QUESTIONS_PER_PAGE).all()
+                current_questions = _rows_to_dicts(reversed(selection))
+                total_questions = db.session.query(
+                    func.count(Question.id)).scalar()
+
+            except SQLAlchemyError:
+                db.session.rollback()
+                app.logger.error('Getting the questions after creating '
+                                 'question %s failed after %.3fs', question_id,
+                                 time.monotonic() - start, exc_info=True)
+
+            # Return data to view
+            return ojson({
+                'success': True,
+                'created': question_id,
+                'questions': current_questions,
+                'total_questions': total_questions
+            })
+
     '''
     @Done: 
     Create a POST endpoint to get questions based on a search term. 
@@ -268,17 +472,17 @@ def create_app(test_config=None):
             abort(400)
 
         # Get only the question for this category
-        selection = Question.query.filter(
-            Question.category == category.id).all()
+        selection = query_question_rows().filter(
+            Question.category == category.id).order_by(Question.id)
 
         # Get current questions to view
         current_questions = paginate_questions(request, selection)
 
         # return data to view
-        return jsonify({
+        return ojson({
             'success': True,
             'questions': current_questions,
-            'total_questions': len(selection),
+            'total_questions': count_questions(selection),
             'current_category': category.type
         })
 
@@ -300,7 +504,7 @@ def create_app(test_config=None):
         '''
 
         # Get the body from the request object
-        body = request.get_json()
+        body = _json_body()
 
         # get the previous_questions from the body
         previous_questions = body.get('previous_questions')
@@ -317,29 +521,29 @@ def create_app(test_config=None):
 
         # Get questions for all categories if all was selected
         if (category_id == 0):
-            questions = Question.query
+            questions = query_questions()
         # or Get question for selected category
         else:
-            questions = Question.query.filter(
+            questions = query_questions().filter(
                 Question.category == quiz_category['id'])
 
-        # if there is previouse_questions filter them from questions
+        # if there is previouse_questions filter them from questions,
+        # they are sent as a single int array parameter (id <> ALL(array))
+        # instead of one NOT IN parameter per previous question
         if len(previous_questions) != 0:
-            questions = questions.filter(
-                ~Question.id.in_(previous_questions)).all()
-        else:
-            questions = questions.all()
+            questions = questions.filter(Question.id != all_(
+                literal(previous_questions, ARRAY(Integer))))
 
-        if len(questions) == 0:
-            return jsonify({
+        # Get random question picked by the database
+        question = questions.order_by(func.random()).first()
+
+        if question is None:
+            return ojson({
                 'success': True
             })
 
-        # Get random question
-        question = random.choice(questions)
-
         # return the question
-        return jsonify({
+        return ojson({
             'success': True,
             'question': question.format()
         })
@@ -351,34 +555,22 @@ def create_app(test_config=None):
     '''
     @app.errorhandler(400)
     def bad_request(error):
-        return jsonify({
-            'success': False,
-            'error': 400,
-            'message': "bad request"
-        }), 400
+        return app.response_class(_ERR[400], status=400,
+                                  mimetype='application/json')
 
     @app.errorhandler(404)
     def not_found(error):
-        return jsonify({
-            'success': False,
-            'error': 404,
-            'message': "resource not found"
-        }), 404
+        return app.response_class(_ERR[404], status=404,
+                                  mimetype='application/json')
 
     @app.errorhandler(405)
     def not_allowed(error):
-        return jsonify({
-            'success': False,
-            'error': 405,
-            'message': "method not allowed"
-        }), 405
+        return app.response_class(_ERR[405], status=405,
+                                  mimetype='application/json')
 
     @app.errorhandler(422)
     def unprocessable(error):
-        return jsonify({
-            'success': False,
-            'error': 422,
-            'message': "unprocessable"
-        }), 422
+        return app.response_class(_ERR[422], status=422,
+                                  mimetype='application/json')
 
     return app
@@ -0,0 +1,34 @@
+import os
+import multiprocessing
+
+# Gunicorn settings to serve the api with gevent workers so a worker keeps
+# serving other requests while one is waiting on postgres
+bind = '0.0.0.0:5000'
+# A gevent worker already serves many requests at once, so one per core
+workers = int(os.environ.get('GUNICORN_WORKERS', multiprocessing.cpu_count()))
+worker_class = 'gevent'
+# Requests above the worker database pool wait up to pool_timeout for it
+worker_connections = 100
+
+# The max_connections of the postgres server (100 by default)
+max_db_connections = int(os.environ.get('DB_MAX_CONNECTIONS', 100))
+
+
+def on_starting(server):
+    # The pool size of the app (DB_POOL_SIZE and DB_MAX_OVERFLOW)
+    from models import pool_size, max_overflow
+
+    # Each worker opens its own pool, all of them must fit in the server limit
+    workers = server.cfg.workers
+    total = workers * (pool_size + max_overflow)
+    if total > max_db_connections:
+        server.log.warning(
+            '%d workers can open %d database connections, more than the '
+            '%d allowed by postgres, lower GUNICORN_WORKERS, DB_POOL_SIZE '
+            'or DB_MAX_OVERFLOW', workers, total, max_db_connections)
+
+
+def post_fork(server, worker):
+    # Make psycopg2 yield to the other greenlets while waiting on postgres
+    from psycogreen.gevent import patch_psycopg
+    patch_psycopg()
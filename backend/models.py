@@ -1,5 +1,5 @@
 import os
-from sqlalchemy import Column, String, Integer, create_engine
+from sqlalchemy import Column, String, Integer, Index, DDL, event, create_engine
 from flask_sqlalchemy import SQLAlchemy
 import json
 
@@ -7,6 +7,10 @@ database_name = "trivia"
 database_path = "postgres://{}:{}@{}/{}".format(
     'ribo', 'mfc', 'localhost:5432', database_name)
 
+# Connection pool size of each process, every gunicorn worker has its own
+pool_size = int(os.environ.get('DB_POOL_SIZE', 5))
+max_overflow = int(os.environ.get('DB_MAX_OVERFLOW', 10))
+
 db = SQLAlchemy()
 
 '''
@@ -23,6 +27,22 @@ def setup_db(app, database_path=database_path):
     db.create_all()
 
 
+'''
+format_question(row)
+    formats a question object or a question columns row as a dict
+'''
+
+
+def format_question(row):
+    return {
+        'id': row.id,
+        'question': row.question,
+        'answer': row.answer,
+        'category': row.category,
+        'difficulty': row.difficulty
+    }
+
+
 '''
 Question
 
@@ -31,6 +51,14 @@ Question
 
 class Question(db.Model):
     __tablename__ = 'questions'
+    __table_args__ = (
+        # Trigram index to use for the substring search on the question
+        Index('ix_questions_question_trgm', 'question',
+              postgresql_using='gin',
+              postgresql_ops={'question': 'gin_trgm_ops'}),
+        # Composite index for filtering by category ordered by id
+        Index('ix_questions_category_id', 'category', 'id'),
+    )
 
     id = Column(Integer, primary_key=True)
     question = Column(String)
@@ -56,13 +84,13 @@ class Question(db.Model):
         db.session.commit()
 
     def format(self):
-        return {
-            'id': self.id,
-            'question': self.question,
-            'answer': self.answer,
-            'category': self.category,
-            'difficulty': self.difficulty
-        }
+        return format_question(self)
+
+
+# The trigram index needs the pg_trgm extension to be created first
+event.listen(Question.__table__, 'before_create',
+             DDL('CREATE EXTENSION IF NOT EXISTS pg_trgm').execute_if(
+                 dialect='postgresql'))
 
 
 '''
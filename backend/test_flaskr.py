@@ -1,23 +1,35 @@
 import os
+import gzip
 import unittest
 import json
-from flask_sqlalchemy import SQLAlchemy
 
 from flaskr import create_app
-from models import setup_db, Question, Category
+from models import setup_db, db, Question, Category
 
 
 class TriviaTestCase(unittest.TestCase):
     """This class represents the trivia test case"""
 
+    @classmethod
+    def setUpClass(cls):
+        """Initialize the app and the test database once for all tests."""
+        cls.app = create_app()
+        cls.database_name = "trivia_test"
+        cls.database_path = "postgres://{}:{}@{}/{}".format(
+            'ribo', 'mfc', 'localhost:5432', cls.database_name)
+        setup_db(cls.app, cls.database_path)
+        cls.session = db.session
+
     def setUp(self):
-        """Define test variables and initialize app."""
-        self.app = create_app()
+        """Define test variables and start a transaction for the test."""
         self.client = self.app.test_client
-        self.database_name = "trivia_test"
-        self.database_path = "postgres://{}:{}@{}/{}".format(
-            'ribo', 'mfc', 'localhost:5432', self.database_name)
-        setup_db(self.app, self.database_path)
+
+        # Bind the app session to a connection inside a transaction,
+        # the commits of the endpoints are rolled back after each test
+        self.connection = db.engine.connect()
+        self.trans = self.connection.begin()
+        db.session = db.create_scoped_session(
+            options={'bind': self.connection, 'binds': {}})
 
         self.new_question = {
             'question': 'What is the best programming language',
@@ -26,15 +38,12 @@ class TriviaTestCase(unittest.TestCase):
             'category': '1'
         }
 
-        with self.app.app_context():
-            self.db = SQLAlchemy()
-            self.db.init_app(self.app)
-
-            self.db.create_all()
-
     def tearDown(self):
         """Executed after reach test"""
-        pass
+        db.session.remove()
+        self.trans.rollback()
+        self.connection.close()
+        db.session = self.session
 
     """
     Done
@@ -49,6 +58,44 @@ class TriviaTestCase(unittest.TestCase):
         self.assertEqual(data['success'], True)
         self.assertTrue(len(data['categories']))
 
+    def test_304_if_categories_not_modified(self):
+        res = self.client().get('/categories')
+        etag = res.headers['ETag']
+        res = self.client().get('/categories', headers={'If-None-Match': etag})
+
+        self.assertEqual(res.status_code, 304)
+        self.assertEqual(res.headers['ETag'], etag)
+        self.assertFalse(res.data)
+
+    def test_retrieve_categories_without_gzip(self):
+        res = self.client().get('/categories',
+                                headers={'Accept-Encoding': 'gzip;q=0'})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertNotIn('Content-Encoding', res.headers)
+        self.assertEqual(data['success'], True)
+        self.assertTrue(len(data['categories']))
+
+    def test_retrieve_categories_with_gzip(self):
+        res = self.client().get('/categories',
+                                headers={'Accept-Encoding': 'gzip'})
+        data = json.loads(gzip.decompress(res.data))
+        plain = json.loads(self.client().get('/categories').data)
+        etag = res.headers['ETag']
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(data, plain)
+        self.assertTrue(etag.endswith('-gzip"'))
+
+        res = self.client().get('/categories',
+                                headers={'Accept-Encoding': 'gzip',
+                                         'If-None-Match': etag})
+
+        self.assertEqual(res.status_code, 304)
+        self.assertEqual(res.headers['ETag'], etag)
+
     def test_retrieve_paginated_questions(self):
         res = self.client().get('/questions')
         data = json.loads(res.data)
@@ -58,6 +105,35 @@ class TriviaTestCase(unittest.TestCase):
         self.assertTrue(data['total_questions'])
         self.assertTrue(len(data['questions']))
 
+    def test_retrieve_questions_after_cursor(self):
+        first_page = json.loads(self.client().get('/questions').data)
+        res = self.client().get(
+            '/questions?after={}'.format(first_page['next_cursor']))
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertTrue(len(data['questions']))
+        self.assertGreater(data['questions'][0]['id'],
+                           first_page['questions'][-1]['id'])
+
+    def test_400_if_retrieving_questions_after_invalid_cursor(self):
+        res = self.client().get('/questions?after=invalid')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data['success'], False)
+        self.assertEqual(data['message'], 'bad request')
+
+    def test_stream_questions(self):
+        res = self.client().get('/questions/stream')
+        data = json.loads(res.data)
+        total = json.loads(self.client().get('/questions').data)['total_questions']
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(len(data), total)
+        self.assertTrue(all(question['id'] for question in data))
+
     def test_404_sent_beyond_valid_page(self):
         res = self.client().get('/questions?page=999')
         data = json.loads(res.data)
@@ -79,6 +155,14 @@ class TriviaTestCase(unittest.TestCase):
         self.assertTrue(len(data['questions']))
         self.assertTrue(data['total_questions'])        
 
+    def test_404_if_question_does_not_exist(self):
+        res = self.client().delete('/questions/1000')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 404)
+        self.assertEqual(data['success'], False)
+        self.assertEqual(data['message'], 'resource not found')
+
     def test_create_new_question(self):
         res = self.client().post('/questions', json=self.new_question)
         data = json.loads(res.data)
@@ -108,6 +192,15 @@ class TriviaTestCase(unittest.TestCase):
         self.assertEqual(data['message'], 'unprocessable')
 
 
+    def test_400_if_creating_new_question_with_invalid_json(self):
+        res = self.client().post('/questions', data='{invalid',
+                                 content_type='application/json')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data['success'], False)
+        self.assertEqual(data['message'], 'bad request')
+
     def test_search_for_questions(self):
         res = self.client().post('/questions',
                                       json={'searchTerm': 'what'})
@@ -115,7 +208,7 @@ class TriviaTestCase(unittest.TestCase):
 
         self.assertEqual(res.status_code, 200)
         self.assertEqual(data['success'], True)
-        self.assertEqual(data['total_questions'], 9)
+        self.assertEqual(data['total_questions'], 8)
         self.assertTrue(len(data['questions']))
 
     def test_404_if_search_for_questions_fails(self):
@@ -155,6 +248,25 @@ class TriviaTestCase(unittest.TestCase):
         self.assertTrue(data['question'])
         self.assertEqual(data['question']['category'], 6)
 
+    def test_play_quiz_skips_previous_questions(self):
+        res = self.client().post('/quizzes',
+                                 json={'previous_questions': [10],
+                                       'quiz_category': {'type': 'Sports', 'id': '6'}})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertEqual(data['question']['id'], 11)
+
+    def test_play_quiz_without_remaining_questions(self):
+        res = self.client().post('/quizzes',
+                                 json={'previous_questions': [10, 11],
+                                       'quiz_category': {'type': 'Sports', 'id': '6'}})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data, {'success': True})
+
     def test_400_play_quiz_fails(self):
         res = self.client().post('/quizzes', json={})
         data = json.loads(res.data)